@@ -4,55 +4,116 @@
 updatemanager.py -- checks for updates to tfutils on GitHub and retrieves them.
 """
 
+import copy
 import datetime
+from distutils.spawn import find_executable
+import errno
+import gzip
+import httplib
 try:
     import json
 except ImportError:
     import simplejson as json
+try:
+    import ujson as fastjson
+except ImportError:
+    fastjson = json
+try:
+    import ijson
+except ImportError:
+    ijson = None
+import io
+import itertools
+import multiprocessing
+import operator
 import os
 from os import path
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+import Queue
 import re
+import shutil
+import socket
+import subprocess
+import sys
 import tarfile
+import threading
 import time
-import urllib
+import urlparse
 
 import modules
 
-VERSIONS_DIR_PATH = path.join(path.dirname(path.abspath(__file__)), "versions")
+TFUTILS_DIR_PATH = path.dirname(path.abspath(__file__))
+VERSIONS_DIR_PATH = path.join(TFUTILS_DIR_PATH, "versions")
 TARBALL_DIR_PATH = path.join(VERSIONS_DIR_PATH, "tarballs")
 BACKUP_DIR_PATH = path.join(VERSIONS_DIR_PATH, "backups")
 ORIGIN_CONFIG_PATH = path.join(VERSIONS_DIR_PATH, "origin.js")
 VERSIONS_INFO_PATH = path.join(VERSIONS_DIR_PATH, "versioninfo.js")
 GITHUB_DOMAIN = "github.com"
-UNPACK_DIR_PATH = path.dirname(path.dirname(path.abspath(__file__)))
-BACKUP_SOURCE_DIR_PATH = path.dirname(path.abspath(__file__))
+TFUTILS_PREFIX = "tfutils"
+UNPACK_DIR_PATH = path.dirname(TFUTILS_DIR_PATH)
+BACKUP_SOURCE_DIR_PATH = TFUTILS_DIR_PATH
+
+# filter_backup expects absolute, normalized paths.
+BACKUP_BUILD_INFIX = os.sep + "build" + os.sep
+BACKUP_GIT_INFIX = os.sep + ".git" + os.sep
+BACKUP_EXCLUDE_PREFIXES = (BACKUP_DIR_PATH + os.sep, TARBALL_DIR_PATH + os.sep)
+BACKUP_EXCLUDE_SUFFIXES = (".pyc", BACKUP_BUILD_INFIX[:-1],
+                           BACKUP_GIT_INFIX[:-1], BACKUP_DIR_PATH,
+                           TARBALL_DIR_PATH)
+
+TARBALL_PREFIX = "tarball_"
+TARBALL_SUFFIX = ".tar.gz"
+TARBALL_RE = re.compile(r"^" + re.escape(TARBALL_PREFIX) + r"\d{4}(_\d{2}){5}"
+                        + re.escape(TARBALL_SUFFIX) + r"$")
 
-TARBALL_RE = re.compile(r"^tarball_\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2}"
-                        r"\.tar\.gz$")
-TIMEZONE_RE = re.compile(r"[+]|[-]\d{2}[:]?\d{2}$")
+FILE_CACHE = {}
+
+HTTP_TIMEOUT = 30.0
+HTTP_POOL_SIZE = 4
+HTTP_MAX_REDIRECTS = 5
+HTTP_REDIRECT_STATUSES = (301, 302, 303, 307)
+DOWNLOAD_BUFSIZE = 128 * 1024
+BACKUP_FILE_BUFSIZE = 1 << 20
+BACKUP_TAR_BUFSIZE = 64 * 1024
+BACKUP_COMPRESSLEVEL = 6
 
-DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
 def parse_dt(sDt):
-    sDtClean,sTz = TIMEZONE_RE.split(sDt, 1)
+    # GitHub dates are fixed-width YYYY-MM-DDTHH:MM:SS followed by a UTC
+    # offset, so slicing is much cheaper than strptime.
     # TODO(jhoon): incorporate the timezone information.
-    return datetime.datetime.strptime(sDtClean, DATETIME_FORMAT)
+    return datetime.datetime(int(sDt[0:4]), int(sDt[5:7]), int(sDt[8:10]),
+                             int(sDt[11:13]), int(sDt[14:16]),
+                             int(sDt[17:19]))
 
 def urljoin(*listSParts):
     sUrl = "/".join(listSParts)
     return sUrl
 
 class Commit(object):
-    def __init__(self, id, sMessage, dt):
+    __slots__ = ("id", "sMessage", "dt", "sEtag")
+    def __init__(self, id, sMessage, dt, sEtag=None):
         self.id = id
         self.sMessage = sMessage
         self.dt = dt
+        # ETag of the commit listing this commit was read from, if any.
+        self.sEtag = sEtag
     def to_json(self):
-        return {"id":self.id, "message": self.sMessage,
-                "committed_date": self.dt.isoformat() + "-0000"}
+        dictJs = {"id":self.id, "message": self.sMessage,
+                  "committed_date": self.dt.isoformat() + "-0000"}
+        if self.sEtag is not None:
+            dictJs["etag"] = self.sEtag
+        return dictJs
     @classmethod
     def from_json(self, dictCommit):
         dt = parse_dt(dictCommit["committed_date"])
-        return Commit(dictCommit["id"], dictCommit["message"], dt)
+        return Commit(dictCommit["id"], dictCommit["message"], dt,
+                      dictCommit.get("etag"))
     @classmethod
     def empty(cls):
         dt = datetime.datetime.fromtimestamp(0.0)
@@ -60,65 +121,260 @@ class Commit(object):
     def __repr__(self):
         return "Commit(%r,%r,%r)" % (self.id, self.sMessage, self.dt)
 
+class PooledResponse(object):
+    def __init__(self, pool, tplKey, conn, resp):
+        self.pool = pool
+        self.tplKey = tplKey
+        self.conn = conn
+        self.resp = resp
+        self.status = resp.status
+    def getheader(self, sName, sDefault=None):
+        return self.resp.getheader(sName, sDefault)
+    def read(self, cBytes=None):
+        return self.resp.read(cBytes)
+    def close(self):
+        if self.conn is None:
+            return
+        conn,self.conn = self.conn,None
+        # Only a fully-read response leaves the connection ready for reuse.
+        if self.resp.isclosed():
+            self.pool.release(self.tplKey, conn)
+        else:
+            self.resp.close()
+            conn.close()
+
+# Keeps idle HTTP connections open, keyed on (scheme, host), so that repeated
+# requests to GitHub reuse one TCP/TLS session.
+class ConnectionPool(object):
+    def __init__(self, cMaxIdle=HTTP_POOL_SIZE, dblTimeout=HTTP_TIMEOUT):
+        self.cMaxIdle = cMaxIdle
+        self.dblTimeout = dblTimeout
+        self.dictIdle = {}
+        self.lock = threading.Lock()
+    def connect(self, tplKey):
+        sScheme,sHost = tplKey
+        if sScheme == "https":
+            return httplib.HTTPSConnection(sHost, timeout=self.dblTimeout)
+        return httplib.HTTPConnection(sHost, timeout=self.dblTimeout)
+    def acquire(self, tplKey):
+        self.lock.acquire()
+        try:
+            listConn = self.dictIdle.get(tplKey)
+            if listConn:
+                return listConn.pop(),True
+        finally:
+            self.lock.release()
+        return self.connect(tplKey),False
+    def release(self, tplKey, conn):
+        self.lock.acquire()
+        try:
+            listConn = self.dictIdle.setdefault(tplKey, [])
+            if len(listConn) < self.cMaxIdle:
+                listConn.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+    def open(self, sMethod, sUrl, dictHeaders):
+        tplUrl = urlparse.urlsplit(sUrl)
+        tplKey = (tplUrl.scheme, tplUrl.netloc)
+        sSelector = tplUrl.path or "/"
+        if tplUrl.query:
+            sSelector += "?" + tplUrl.query
+        conn,fReused = self.acquire(tplKey)
+        try:
+            conn.request(sMethod, sSelector, headers=dictHeaders)
+            resp = conn.getresponse()
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            if not fReused:
+                raise
+            # The server may have dropped an idle keep-alive connection.
+            conn = self.connect(tplKey)
+            conn.request(sMethod, sSelector, headers=dictHeaders)
+            resp = conn.getresponse()
+        return PooledResponse(self, tplKey, conn, resp)
+    def request(self, sMethod, sUrl, dictHeaders=None):
+        dictHeaders = dict(dictHeaders or {})
+        for iRedirect in xrange(HTTP_MAX_REDIRECTS + 1):
+            resp = self.open(sMethod, sUrl, dictHeaders)
+            if resp.status not in HTTP_REDIRECT_STATUSES:
+                return resp
+            sLocation = resp.getheader("location")
+            resp.read()
+            resp.close()
+            if sLocation is None:
+                break
+            sUrl = urlparse.urljoin(sUrl, sLocation)
+        raise IOError("Could not follow redirects for %s" % sUrl)
+    def clear(self):
+        self.lock.acquire()
+        try:
+            dictIdle,self.dictIdle = self.dictIdle,{}
+        finally:
+            self.lock.release()
+        for listConn in dictIdle.values():
+            for conn in listConn:
+                conn.close()
+
+# Shared by check_for_updates and deploy_updates so that both reuse the same
+# connections to GitHub.
+HTTP_POOL = ConnectionPool()
+
+def http_get(sUrl, dictHeaders=None, tplStatus=(httplib.OK,)):
+    resp = HTTP_POOL.request("GET", sUrl, dictHeaders)
+    if resp.status not in tplStatus:
+        resp.close()
+        raise IOError("HTTP %d fetching %s" % (resp.status, sUrl))
+    return resp
+
 def github_api_call(*listArgs):
     listSPieces = [GITHUB_DOMAIN, "api", "v2", "json"] + list(listArgs)
     return "http://" + urljoin(*listSPieces)
 
-def github_last_commit(sUser,sRepo,sBranch):
+def iter_commits_json(infile):
+    if ijson is not None:
+        return ijson.items(infile, "commits.item")
+    return iter(fastjson.loads(infile.read())["commits"])
+
+def github_last_commit(sUser,sRepo,sBranch,cmtCached=None):
     sUrl = github_api_call("commits", "list", sUser, sRepo, sBranch)
-    infile = None
+    dictHeaders = {}
+    if cmtCached is not None and cmtCached.sEtag:
+        dictHeaders["If-None-Match"] = cmtCached.sEtag
+    resp = http_get(sUrl, dictHeaders, (httplib.OK, httplib.NOT_MODIFIED))
     try:
-        infile = urllib.urlopen(sUrl)
-        dictJson = json.load(infile)
+        if resp.status == httplib.NOT_MODIFIED:
+            resp.read()
+            return cmtCached
+        sEtag = resp.getheader("etag")
+        # The listing is newest-first in practice, but committed_date is not
+        # guaranteed to be monotonic, so keep a running max over the whole
+        # body. It has to be read to the end anyway for the connection to be
+        # reused.
+        itCommit = itertools.imap(Commit.from_json, iter_commits_json(resp))
+        cmtFirst = next(itCommit, None)
+        if cmtFirst is None:
+            return None
+        cmtLatest = max(itertools.chain((cmtFirst,), itCommit),
+                        key=operator.attrgetter("dt"))
     finally:
-        if infile is not None:
-            infile.close()
-    listCommit = map(Commit.from_json, dictJson["commits"])
-    listCommit.sort(lambda a,b: -cmp(a.dt,b.dt))
-    return (listCommit and listCommit[0]) or None
+        resp.close()
+    cmtLatest.sEtag = sEtag
+    return cmtLatest
 
-def tarball_filename():
+def timestamped_name(sPrefix, sSuffix=""):
     dt = datetime.datetime.now()
     tpl = (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
-    return "tarball_%04d_%02d_%02d_%02d_%02d_%02d.tar.gz" % tpl
+    return sPrefix + "%04d_%02d_%02d_%02d_%02d_%02d" % tpl + sSuffix
+
+def tarball_filename():
+    return timestamped_name(TARBALL_PREFIX, TARBALL_SUFFIX)
+
+def is_tarball_name(sFilename):
+    return TARBALL_RE.match(sFilename) is not None
 
 def github_tarball(sUser,sRepo,sBranch):
     return "https://" + urljoin(GITHUB_DOMAIN,sUser,sRepo,"tarball",sBranch)
 
-def load_origin_config(sPath=ORIGIN_CONFIG_PATH):    
-    return json.load(open(sPath))
+def load_json_file(sPath):
+    infile = open(sPath, "rb")
+    try:
+        return fastjson.loads(infile.read())
+    finally:
+        infile.close()
+
+def load_cached(sPath, fxnLoad):
+    # Reuse the last result of fxnLoad(sPath) for as long as the file's mtime
+    # and size are unchanged, so repeated polling costs one stat.
+    st = os.stat(sPath)
+    tplStamp = (st.st_mtime, st.st_size)
+    tplKey = (sPath, fxnLoad)
+    tplCached = FILE_CACHE.get(tplKey)
+    if tplCached is not None and tplCached[0] == tplStamp:
+        return tplCached[1]
+    o = fxnLoad(sPath)
+    FILE_CACHE[tplKey] = (tplStamp, o)
+    return o
+
+def forget_cached(sPath):
+    for tplKey in FILE_CACHE.keys():
+        if tplKey[0] == sPath:
+            del FILE_CACHE[tplKey]
+
+def load_origin_config(sPath=ORIGIN_CONFIG_PATH):
+    return load_cached(sPath, load_json_file)
+
+def load_commit_file(sPath):
+    return Commit.from_json(load_json_file(sPath))
 
 def load_version_commit(sPath=VERSIONS_INFO_PATH):
     if not path.isfile(sPath):
         return Commit.empty()
-    return Commit.from_json(json.load(open(sPath)))
+    return load_cached(sPath, load_commit_file)
 
-def latest_commit(dictOriginConfig, sBranchType):
+def latest_commit(dictOriginConfig, sBranchType, cmtCached=None):
     sUser = dictOriginConfig["user"]
     sRepo = dictOriginConfig["repo"]
     sBranch = dictOriginConfig["branches"][sBranchType]
-    return github_last_commit(sUser,sRepo,sBranch)
+    return github_last_commit(sUser,sRepo,sBranch,cmtCached)
 
 def is_update_available(cmtLatest,cmtVersion):
     return cmtLatest if cmtLatest.dt > cmtVersion.dt else None
 
-def download_tarball(dictOriginConfig,sBranchType):
+def tarball_url(dictOriginConfig,sBranchType):
     sUser = dictOriginConfig["user"]
     sRepo = dictOriginConfig["repo"]
     sBranch = dictOriginConfig["branches"][sBranchType]
-    sUrl = github_tarball(sUser,sRepo,sBranch)
+    return github_tarball(sUser,sRepo,sBranch)
+
+def warm_tarball_connection(dictOriginConfig,sBranchType):
+    # HEAD the tarball (following its redirects) in the background so the
+    # connections a download needs are already open in HTTP_POOL.
+    sUrl = tarball_url(dictOriginConfig,sBranchType)
+    def head():
+        try:
+            resp = HTTP_POOL.request("HEAD", sUrl)
+            resp.read()
+            resp.close()
+        except (EnvironmentError, httplib.HTTPException):
+            pass
+    tr = threading.Thread(target=head)
+    tr.daemon = True
+    tr.start()
+    return tr
+
+def download_tarball(dictOriginConfig,sBranchType):
+    sUrl = tarball_url(dictOriginConfig,sBranchType)
     sFilename = tarball_filename()
     if not path.exists(TARBALL_DIR_PATH):
         os.makedirs(TARBALL_DIR_PATH)
     sFullFilename = path.join(TARBALL_DIR_PATH, sFilename)
-    urllib.urlretrieve(sUrl, sFullFilename)
+    resp = http_get(sUrl)
+    try:
+        outfile = open(sFullFilename, "wb", DOWNLOAD_BUFSIZE)
+        try:
+            shutil.copyfileobj(resp, outfile, DOWNLOAD_BUFSIZE)
+        finally:
+            outfile.close()
+    finally:
+        resp.close()
     return sFullFilename
 
 def clean_downloads():
-    for sFilename in os.listdir(TARBALL_DIR_PATH):
-        if TARBALL_RE.match(sFilename) is not None:
-            sFullPath = path.join(TARBALL_DIR_PATH, sFilename)
-            os.unlink(sFullPath)
+    if scandir is None:
+        for sFilename in os.listdir(TARBALL_DIR_PATH):
+            if is_tarball_name(sFilename):
+                sFullPath = path.join(TARBALL_DIR_PATH, sFilename)
+                if path.isfile(sFullPath):
+                    os.unlink(sFullPath)
+        return
+    # scandir reports the entry type straight from the directory listing, so
+    # skipping anything that is not a plain file costs no extra stat.
+    for entry in scandir(TARBALL_DIR_PATH):
+        if (is_tarball_name(entry.name)
+            and entry.is_file(follow_symlinks=False)):
+            os.unlink(entry.path)
 
 def splitall(s):
     listComp = []
@@ -141,63 +397,297 @@ def is_relevant_file(s):
 def check_for_updates(dictOriginConfig=None,sBranchType="master"):
     if dictOriginConfig is None:
         dictOriginConfig = load_origin_config()
-    cmtLatest = latest_commit(dictOriginConfig, sBranchType)
     cmtVersion = load_version_commit()
-    return is_update_available(cmtLatest,cmtVersion)
+    # The installed commit carries the ETag of the listing it came from, so
+    # an unchanged branch costs a bodiless 304.
+    cmtLatest = latest_commit(dictOriginConfig, sBranchType, cmtVersion)
+    cmtUpdate = is_update_available(cmtLatest,cmtVersion)
+    if (cmtUpdate is None and cmtLatest is not None
+        and cmtLatest.sEtag != cmtVersion.sEtag):
+        # Already current, but the listing had a new ETag; remember it so the
+        # next poll can be answered with a 304.
+        update_version_info(Commit(cmtVersion.id, cmtVersion.sMessage,
+                                   cmtVersion.dt, cmtLatest.sEtag))
+    return cmtUpdate
 
-def unpack_tarball(sTarballFilename, sUnpackOnto, sUser, sRepo):
+def github_prefix_re(sUser, sRepo):
     sReSrc = r'^%s-%s-\w+' % (re.escape(sUser), re.escape(sRepo))
-    rePrefix = re.compile(sReSrc)
-    sPref = "tfutils"
-    tf = tarfile.open(sTarballFilename)
-    for ti in tf.getmembers():
-        ti.name = rePrefix.sub(sPref,ti.name,1)
+    return re.compile(sReSrc)
+
+def renamed_members(tf, rePrefix):
+    # Iterating the archive (rather than calling getmembers) also works on
+    # non-seekable streams.
+    for ti in tf:
+        ti.name = rePrefix.sub(TFUTILS_PREFIX,ti.name,1)
+        if ti.islnk():
+            # Hard link targets are archive member names, so they need the
+            # same rename.
+            ti.linkname = rePrefix.sub(TFUTILS_PREFIX,ti.linkname,1)
         if is_relevant_file(ti.name):
-            tf.extract(ti,sUnpackOnto)
+            yield ti
+
+def write_member(ti, sData, sUnpackOnto):
+    sDest = path.join(sUnpackOnto, ti.name)
+    sDir = path.dirname(sDest)
+    if not path.isdir(sDir):
+        try:
+            os.makedirs(sDir)
+        except OSError:
+            # Another writer may have created it first.
+            if not path.isdir(sDir):
+                raise
+    # Replace the file instead of truncating it, so that any hard-linked
+    # snapshot of it (see snapshot_current) keeps the old contents.
+    try:
+        os.unlink(sDest)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    outfile = open(sDest, "wb", 0)
+    try:
+        outfile.write(sData)
+    finally:
+        outfile.close()
+    os.chmod(sDest, ti.mode & 07777)
+    os.utime(sDest, (ti.mtime, ti.mtime))
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def extract_members(tf, sUnpackOnto, sUser, sRepo, cWriters=None):
+    if cWriters is None:
+        cWriters = cpu_count()
+    rePrefix = github_prefix_re(sUser, sRepo)
+    # The tar stream has to be read in order, but saving its files need not
+    # be: this thread reads regular members into memory and hands them to a
+    # pool of writers through a bounded queue.
+    queueMember = Queue.Queue(cWriters * 2)
+    listExcInfo = []
+    def writer():
+        while True:
+            tpl = queueMember.get()
+            try:
+                if tpl is None:
+                    return
+                if not listExcInfo:
+                    write_member(tpl[0], tpl[1], sUnpackOnto)
+            except Exception:
+                listExcInfo.append(sys.exc_info())
+            finally:
+                queueMember.task_done()
+    listTr = [threading.Thread(target=writer) for i in xrange(cWriters)]
+    for tr in listTr:
+        tr.daemon = True
+        tr.start()
+    listTiDir = []
+    try:
+        for ti in renamed_members(tf, rePrefix):
+            if listExcInfo:
+                break
+            if ti.isreg():
+                infile = tf.extractfile(ti)
+                try:
+                    sData = infile.read()
+                finally:
+                    infile.close()
+                queueMember.put((ti, sData))
+                continue
+            if ti.isdir():
+                listTiDir.append(ti)
+                ti = copy.copy(ti)
+                ti.mode = 0700
+            elif ti.islnk():
+                # A hard link needs its target on disk already.
+                queueMember.join()
+            tf.extract(ti, sUnpackOnto)
+    finally:
+        for tr in listTr:
+            queueMember.put(None)
+        for tr in listTr:
+            tr.join()
+    if listExcInfo:
+        tplExcInfo = listExcInfo[0]
+        raise tplExcInfo[0], tplExcInfo[1], tplExcInfo[2]
+    # As TarFile.extractall does, fix up directories last (deepest first) so
+    # that writing their contents doesn't disturb their mode or mtime.
+    listTiDir.sort(key=operator.attrgetter("name"), reverse=True)
+    for ti in listTiDir:
+        sDest = path.join(sUnpackOnto, ti.name)
+        os.chmod(sDest, ti.mode & 07777)
+        os.utime(sDest, (ti.mtime, ti.mtime))
+
+def unpack_tarball(sTarballFilename, sUnpackOnto, sUser, sRepo):
+    tf = tarfile.open(sTarballFilename)
+    try:
+        extract_members(tf, sUnpackOnto, sUser, sRepo)
+    finally:
+        tf.close()
+
+def stream_tarball(dictOriginConfig, sBranchType, sUnpackOnto):
+    # Download, gunzip and extract in a single pass over the response, without
+    # writing the tarball to disk. "r|gz" never seeks, so it works directly
+    # on the socket.
+    resp = http_get(tarball_url(dictOriginConfig, sBranchType))
+    try:
+        tf = tarfile.open(fileobj=resp, mode="r|gz", bufsize=DOWNLOAD_BUFSIZE)
+        try:
+            extract_members(tf, sUnpackOnto, dictOriginConfig["user"],
+                            dictOriginConfig["repo"])
+        finally:
+            tf.close()
+    finally:
+        resp.close()
         
 def backup_name():
-    dt = datetime.datetime.now()
-    return ("backup_%04d_%02d_%02d_%02d_%02d_%02d.tar.gz" %
-            (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second))
+    return timestamped_name("backup_", ".tar.gz")
+
+def snapshot_name():
+    return timestamped_name("snapshot_")
+
+def link_or_copy(sSrc, sDst):
+    try:
+        os.link(sSrc, sDst)
+    except (AttributeError, OSError):
+        # No hard links on this platform, or sDst is on another filesystem.
+        shutil.copy2(sSrc, sDst)
+
+def snapshot_current(sRoot):
+    # A quick alternative to backup_current: mirror sRoot with hard links, so
+    # each file costs an inode entry rather than a compressed copy.
+    sRoot = path.abspath(sRoot)
+    sSnapshot = path.join(BACKUP_DIR_PATH, snapshot_name())
+    for sDirPath,listSDir,listSFile in os.walk(sRoot):
+        sDestDir = path.normpath(path.join(sSnapshot,
+                                           path.relpath(sDirPath, sRoot)))
+        os.makedirs(sDestDir)
+        listSWalk = []
+        for sName in listSDir + listSFile:
+            sSrc = path.join(sDirPath, sName)
+            if filter_backup(sSrc):
+                continue
+            sDst = path.join(sDestDir, sName)
+            if path.islink(sSrc):
+                os.symlink(os.readlink(sSrc), sDst)
+            elif path.isdir(sSrc):
+                listSWalk.append(sName)
+            else:
+                link_or_copy(sSrc, sDst)
+        listSDir[:] = listSWalk
+    return sSnapshot
 
 def filter_backup(sPath):
-    return (BACKUP_DIR_PATH in sPath
-            or TARBALL_DIR_PATH in sPath
-            or "/build" in sPath
-            or ".git/" in sPath
-            or sPath.endswith(".pyc"))
+    # The suffixes cover .pyc files and the excluded directories themselves;
+    # the prefixes and infixes cover anything beneath them.
+    return (sPath.endswith(BACKUP_EXCLUDE_SUFFIXES)
+            or sPath.startswith(BACKUP_EXCLUDE_PREFIXES)
+            or BACKUP_BUILD_INFIX in sPath
+            or BACKUP_GIT_INFIX in sPath)
+
+def write_backup_tar(fileobj, sRoot):
+    sRootParent = path.dirname(path.abspath(sRoot))
+    def filter_tarinfo(ti):
+        # ti.name is relative to sRootParent; filter_backup wants the
+        # filesystem path.
+        if filter_backup(path.normpath(path.join(sRootParent, ti.name))):
+            return None
+        return ti
+    tf = tarfile.open(fileobj=fileobj, mode="w|", bufsize=BACKUP_TAR_BUFSIZE)
+    try:
+        tf.add(sRoot, path.basename(sRoot), filter=filter_tarinfo)
+    finally:
+        tf.close()
+
+def backup_with_pigz(sPigz, sRoot, sFullFilename):
+    outfile = open(sFullFilename, "wb")
+    try:
+        proc = subprocess.Popen([sPigz, "-%d" % BACKUP_COMPRESSLEVEL, "-c"],
+                                stdin=subprocess.PIPE, stdout=outfile)
+        fBrokenPipe = False
+        try:
+            write_backup_tar(proc.stdin, sRoot)
+        except IOError, e:
+            # pigz dying mid-backup surfaces here; report its status instead.
+            if e.errno != errno.EPIPE:
+                raise
+            fBrokenPipe = True
+        finally:
+            proc.stdin.close()
+            iStatus = proc.wait()
+    finally:
+        outfile.close()
+    if iStatus != 0 or fBrokenPipe:
+        raise IOError("%s exited with status %d" % (sPigz, iStatus))
+
+def backup_with_gzip(sRoot, sFullFilename):
+    outfile = io.open(sFullFilename, "wb", buffering=BACKUP_FILE_BUFSIZE)
+    try:
+        gz = gzip.GzipFile(fileobj=outfile, mode="wb",
+                           compresslevel=BACKUP_COMPRESSLEVEL)
+        try:
+            write_backup_tar(gz, sRoot)
+        finally:
+            gz.close()
+    finally:
+        outfile.close()
 
 def backup_current(sRoot):
     if not path.exists(BACKUP_DIR_PATH):
         os.makedirs(BACKUP_DIR_PATH)
     sFullFilename = path.join(BACKUP_DIR_PATH, backup_name())
-    tf = tarfile.open(sFullFilename,"w:gz")
-    tf.add(sRoot, path.basename(sRoot), exclude=filter_backup)
-    tf.close()
+    # pigz compresses on every core and still writes an ordinary .tar.gz.
+    sPigz = find_executable("pigz")
+    if sPigz is not None:
+        backup_with_pigz(sPigz, sRoot, sFullFilename)
+    else:
+        backup_with_gzip(sRoot, sFullFilename)
     return sFullFilename
 
 def update_version_info(cmt,sPath=VERSIONS_INFO_PATH):
-    dictJs = cmt.to_json()
-    json.dump(dictJs,open(sPath, "wb"))
+    sJson = fastjson.dumps(cmt.to_json())
+    # Write everything in one call to a temporary file, then rename it into
+    # place so a reader never sees a partially written file.
+    sTmpPath = sPath + ".tmp"
+    outfile = open(sTmpPath, "wb")
+    try:
+        outfile.write(sJson)
+    finally:
+        outfile.close()
+    if os.name == "nt" and path.exists(sPath):
+        # rename() cannot replace an existing file on Windows.
+        os.remove(sPath)
+    os.rename(sTmpPath, sPath)
+    forget_cached(sPath)
 
 def has_git(sPath=BACKUP_SOURCE_DIR_PATH):
     return path.exists(path.join(sPath, ".git"))      
 
-def deploy_updates():
+def deploy_updates(fStreaming=False):
     if has_git():
         return False
     dictOriginConfig = load_origin_config()
     sBranchType = "master"
+    tr = warm_tarball_connection(dictOriginConfig, sBranchType)
     cmt = check_for_updates(dictOriginConfig, sBranchType)
     if cmt is None:
+        # Nothing to download; let the daemon HEAD finish on its own.
         return False
+    tr.join(HTTP_TIMEOUT)
     backup_current(BACKUP_SOURCE_DIR_PATH)
-    sFilename = download_tarball(dictOriginConfig, sBranchType)
-    unpack_tarball(sFilename, UNPACK_DIR_PATH, dictOriginConfig["user"],
-                   dictOriginConfig["repo"])
+    if fStreaming:
+        stream_tarball(dictOriginConfig, sBranchType, UNPACK_DIR_PATH)
+    else:
+        sFilename = download_tarball(dictOriginConfig, sBranchType)
+        unpack_tarball(sFilename, UNPACK_DIR_PATH, dictOriginConfig["user"],
+                       dictOriginConfig["repo"])
     update_version_info(cmt)
     return True
 
+def deploy_updates_streaming():
+    return deploy_updates(fStreaming=True)
+
 def main(argv):
     import optparse
     parser = optparse.OptionParser()
@@ -205,10 +695,17 @@ def main(argv):
                       help="check for updates")
     parser.add_option("-b", "--backup", action="store_true", dest="backup",
                       help="create a backup tarball")
+    parser.add_option("-s", "--snapshot", action="store_true",
+                      dest="snapshot",
+                      help="create a hard-linked snapshot of the current "
+                      "files")
     parser.add_option("-r", "--remove-downloaded", action="store_true",
                       dest="remove_downloaded")
     parser.add_option("-d", "--deploy", action="store_true",
                       dest="deploy")
+    parser.add_option("--stream", action="store_true", dest="stream",
+                      help="with --deploy, unpack the tarball while it "
+                      "downloads instead of saving it first")
     parser.add_option("-g", "--git", action="store_true", dest="git",
                       help="determine if this is a git working copy.")
     opts,args = parser.parse_args(argv)
@@ -227,10 +724,13 @@ def main(argv):
     if opts.backup:
         sFilename = backup_current(BACKUP_SOURCE_DIR_PATH)
         print "Backup created at %s" % sFilename
+    if opts.snapshot:
+        sSnapshot = snapshot_current(BACKUP_SOURCE_DIR_PATH)
+        print "Snapshot created at %s" % sSnapshot
     if opts.remove_downloaded:
         clean_downloads()
     if opts.deploy:
-        if not deploy_updates():
+        if not deploy_updates(opts.stream):
             print "No updates found."
             return 1
         print "Update successful."